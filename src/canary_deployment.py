@@ -4,37 +4,64 @@ Canary Deployment System for Database Changes
 Progressive rollout with automated rollback on errors
 """
 
-import psycopg2
+import numpy as np
+import operator
+from psycopg import sql
+from psycopg_pool import ConnectionPool
 import time
-import random
 from datetime import datetime
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
+# Pooled sessions per environment; traffic runs on one session at a time
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 2
+
+# Untimed traffic queries run on a session right before its timed requests
+WARM_UP_REQUESTS = 10
+
+# Simulated application query, parameterized so one server-side plan serves every request
+TRAFFIC_QUERY = "SELECT * FROM users WHERE email LIKE %s LIMIT 10"
+TRAFFIC_QUERY_PARAMS = ('%test.com',)
+
+# Seed rows for users, pre-rendered in COPY text format
+SEED_USERS = "".join(f"user_{i}\tuser{i}@test.com\n" for i in range(1, 101))
+
 
 class CanaryDeployment:
     
     def __init__(self):
-        self.stable_conn = None
-        self.canary_conn = None
+        self.stable_pool = None
+        self.canary_pool = None
         self.canary_percentage = 0
-        self.metrics = {'stable': [], 'canary': []}
+        self.rng = np.random.default_rng()
+        self.phase_start = {}
+        
+        # Rollback thresholds relative to stable, fixed for the deployment
+        self._err_mult = 2.0
+        self._lat_mult = 1.5
+        self._rollback_fields = operator.itemgetter('error_rate', 'p95_latency_ns')
         
     def connect_all(self):
         try:
-            self.stable_conn = psycopg2.connect(
-                host='localhost', port=5454,
-                dbname='stable_db', user='postgres', password='postgres'
+            # prepare_threshold=1 lets psycopg prepare the hot statements server-side
+            self.stable_pool = ConnectionPool(
+                "host=localhost port=5454 dbname=stable_db user=postgres password=postgres",
+                min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                kwargs={'prepare_threshold': 1, 'autocommit': True}, open=True
             )
-            self.stable_conn.autocommit = True
             
-            self.canary_conn = psycopg2.connect(
-                host='localhost', port=5455,
-                dbname='canary_db', user='postgres', password='postgres'
+            self.canary_pool = ConnectionPool(
+                "host=localhost port=5455 dbname=canary_db user=postgres password=postgres",
+                min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                kwargs={'prepare_threshold': 1, 'autocommit': True}, open=True
             )
-            self.canary_conn.autocommit = True
+            
+            # Pools connect in the background; surface connection errors here
+            self.stable_pool.wait()
+            self.canary_pool.wait()
             
             logger.info("Connected to stable and canary databases")
             return True
@@ -45,49 +72,147 @@ class CanaryDeployment:
     def setup(self):
         """Setup both databases"""
         
-        for conn, env in [(self.stable_conn, 'stable'), (self.canary_conn, 'canary')]:
-            cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id SERIAL PRIMARY KEY,
-                    username VARCHAR(100),
-                    email VARCHAR(100),
-                    created_at TIMESTAMP DEFAULT NOW()
-                );
+        for pool, env in [(self.stable_pool, 'stable'), (self.canary_pool, 'canary')]:
+            # One transaction (and one commit) for the whole schema and seed data
+            with pool.connection() as conn, conn.transaction():
+                conn.execute("""
+                    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                    
+                    CREATE TABLE IF NOT EXISTS users (
+                        user_id SERIAL PRIMARY KEY,
+                        username VARCHAR(100),
+                        email VARCHAR(100),
+                        created_at TIMESTAMP DEFAULT NOW()
+                    );
+                    
+                    CREATE TABLE IF NOT EXISTS deployment_metrics (
+                        metric_id SERIAL,
+                        timestamp TIMESTAMP NOT NULL DEFAULT NOW(),
+                        environment VARCHAR(20),
+                        latency_ns BIGINT,
+                        error_rate DECIMAL(5,2),
+                        success_count INT,
+                        error_count INT,
+                        PRIMARY KEY (metric_id, timestamp)
+                    );
+                    
+                    -- Tables created before latency_ns existed stored rounded milliseconds
+                    ALTER TABLE deployment_metrics ADD COLUMN IF NOT EXISTS latency_ns BIGINT;
+                    
+                    CREATE INDEX IF NOT EXISTS idx_dm_env_ts
+                    ON deployment_metrics(environment, timestamp DESC);
+                """)
                 
-                CREATE TABLE IF NOT EXISTS deployment_metrics (
-                    metric_id SERIAL PRIMARY KEY,
-                    timestamp TIMESTAMP DEFAULT NOW(),
-                    environment VARCHAR(20),
-                    query_latency_ms DECIMAL(10,2),
-                    error_rate DECIMAL(5,2),
-                    success_count INT,
-                    error_count INT
-                );
+                self._enable_hypertable(conn, env)
                 
-                INSERT INTO users (username, email)
-                SELECT 'user_' || i, 'user' || i || '@test.com'
-                FROM generate_series(1, 100) i
-                ON CONFLICT DO NOTHING;
-            """)
-            cursor.close()
+                with conn.cursor() as cursor, \
+                        cursor.copy("COPY users (username, email) FROM STDIN") as copy:
+                    copy.write(SEED_USERS)
         
         logger.info("Databases initialized")
     
+    def _enable_hypertable(self, conn, env: str):
+        """Partition deployment_metrics by time when TimescaleDB is installed"""
+        
+        available = conn.execute(
+            "SELECT 1 FROM pg_available_extensions WHERE name = 'timescaledb'"
+        ).fetchone()
+        if not available:
+            return
+        
+        # Savepoint, so a server without timescaledb preloaded keeps the plain table
+        try:
+            with conn.transaction():
+                conn.execute("CREATE EXTENSION IF NOT EXISTS timescaledb")
+        except Exception as e:
+            logger.warning(f"TimescaleDB unavailable on {env}, keeping plain table: {e}")
+            return
+        
+        if not self._migrate_metrics_primary_key(conn, env):
+            return
+        
+        try:
+            with conn.transaction():
+                conn.execute("""
+                    SELECT create_hypertable('deployment_metrics', 'timestamp',
+                                             chunk_time_interval => INTERVAL '1 hour',
+                                             if_not_exists => TRUE, migrate_data => TRUE)
+                """)
+            logger.info(f"deployment_metrics is a TimescaleDB hypertable on {env}")
+        except Exception as e:
+            logger.warning(f"Could not make deployment_metrics a hypertable on {env}: {e}")
+            return
+        
+        # Separate savepoint: Apache-licensed builds lack retention policies, which
+        # must not undo the hypertable conversion
+        try:
+            with conn.transaction():
+                conn.execute("""
+                    SELECT add_retention_policy('deployment_metrics', INTERVAL '7 days',
+                                                if_not_exists => TRUE)
+                """)
+        except Exception as e:
+            logger.warning(f"No retention policy for deployment_metrics on {env}: {e}")
+    
+    def _migrate_metrics_primary_key(self, conn, env: str) -> bool:
+        """Make timestamp part of the deployment_metrics primary key, as hypertables require"""
+        
+        # Tables created before the composite key have PRIMARY KEY (metric_id) or,
+        # if altered by hand, none at all
+        pkey = conn.execute("""
+            SELECT c.conname, array_agg(a.attname::text)
+            FROM pg_constraint c
+            JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey)
+            WHERE c.conrelid = 'deployment_metrics'::regclass AND c.contype = 'p'
+            GROUP BY c.conname
+        """).fetchone()
+        if pkey and 'timestamp' in pkey[1]:
+            return True
+        
+        missing = conn.execute(
+            "SELECT count(*) FROM deployment_metrics WHERE timestamp IS NULL"
+        ).fetchone()[0]
+        if missing:
+            logger.warning(
+                f"{missing} deployment_metrics rows on {env} have no timestamp and cannot be "
+                f"partitioned, keeping plain table"
+            )
+            return False
+        
+        logger.info(f"Adding timestamp to the deployment_metrics primary key on {env}")
+        try:
+            with conn.transaction():
+                conn.execute("ALTER TABLE deployment_metrics ALTER COLUMN timestamp SET NOT NULL")
+                if pkey:
+                    conn.execute(
+                        sql.SQL("ALTER TABLE deployment_metrics DROP CONSTRAINT {}").format(
+                            sql.Identifier(pkey[0])
+                        )
+                    )
+                conn.execute(
+                    "ALTER TABLE deployment_metrics ADD PRIMARY KEY (metric_id, timestamp)"
+                )
+        except Exception as e:
+            logger.warning(
+                f"Could not add timestamp to the deployment_metrics primary key on {env}, "
+                f"keeping plain table: {e}"
+            )
+            return False
+        
+        return True
+    
     def apply_canary_change(self):
         """Apply the new change to canary database"""
         
         logger.info("Applying new schema change to CANARY...")
         
-        cursor = self.canary_conn.cursor()
-        
-        # Simulated change: Add index for performance optimization
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_users_email_optimized 
-            ON users(email, username);
-        """)
+        # Simulated change: trigram index so the leading-wildcard email LIKE can use an index
+        with self.canary_pool.connection() as conn:
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_users_email_trgm 
+                ON users USING gin(email gin_trgm_ops);
+            """)
         
-        cursor.close()
         logger.info("✓ Canary change applied")
     
     def route_traffic(self, percentage: int):
@@ -95,87 +220,116 @@ class CanaryDeployment:
         self.canary_percentage = percentage
         logger.info(f"Traffic routing: {100-percentage}% stable, {percentage}% canary")
     
-    def execute_query(self, query: str, use_canary: bool = False):
-        """Execute query on stable or canary"""
-        
-        conn = self.canary_conn if use_canary else self.stable_conn
-        env = 'canary' if use_canary else 'stable'
+    def execute_query(self, cursor, query: str, params: tuple | None = None):
+        """Execute one query and return its outcome and round-trip latency in ns"""
         
-        cursor = conn.cursor()
-        
-        start_time = time.time()
+        start_time = time.perf_counter_ns()
         success = True
         
         try:
-            cursor.execute(query)
-            cursor.fetchall()
-            latency = (time.time() - start_time) * 1000
-            
-            # Record metric
-            cursor.execute("""
-                INSERT INTO deployment_metrics 
-                (environment, query_latency_ms, error_rate, success_count, error_count)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (env, latency, 0.0, 1, 0))
+            # execute() waits for the server's result; only latency is measured,
+            # so the rows are never fetched
+            cursor.execute(query, params, prepare=True)
+            latency_ns = time.perf_counter_ns() - start_time
             
         except Exception as e:
-            latency = (time.time() - start_time) * 1000
+            latency_ns = time.perf_counter_ns() - start_time
             success = False
-            
-            cursor.execute("""
-                INSERT INTO deployment_metrics 
-                (environment, query_latency_ms, error_rate, success_count, error_count)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (env, latency, 100.0, 0, 1))
-        
-        cursor.close()
         
-        return success, latency
+        return success, latency_ns
     
     def simulate_traffic(self, total_requests: int = 100):
         """Simulate application traffic with canary routing"""
         
         logger.info(f"Simulating {total_requests} requests...")
         
-        for i in range(total_requests):
-            # Decide routing based on canary percentage
-            use_canary = random.randint(1, 100) <= self.canary_percentage
+        # Decide routing for every request up front based on canary percentage
+        route = self.rng.integers(1, 101, size=total_requests) <= self.canary_percentage
+        canary_count = int(route.sum())
+        
+        # Each environment's share runs back to back on a single session, one request
+        # at a time. Concurrent threads would add GIL waits to the timed sections, and
+        # interleaving the environments would leave the minority's backend idle
+        # between its requests, which slows each of them down.
+        for pool, env, count in [(self.stable_pool, 'stable', total_requests - canary_count),
+                                 (self.canary_pool, 'canary', canary_count)]:
+            self._run_share(pool, env, count)
+        
+        logger.info(f"✓ Traffic simulation complete")
+    
+    def _run_share(self, pool, env: str, count: int):
+        """Send one environment's share of the traffic and persist its metrics"""
+        
+        rows = []
+        
+        with pool.connection() as conn, conn.cursor() as cursor:
+            # Server clock marks where this phase's metric rows begin
+            self.phase_start[env] = cursor.execute("SELECT LOCALTIMESTAMP").fetchone()[0]
             
-            # Execute query
-            query = "SELECT * FROM users WHERE email LIKE '%test.com' LIMIT 10"
-            success, latency = self.execute_query(query, use_canary)
+            # The first execution on a session pays an extra Parse round trip to prepare
+            # the query, and the next few run slower on a backend that was idle. Left in
+            # the timed window they would inflate the p95 of the smaller share.
+            if count:
+                for _ in range(WARM_UP_REQUESTS):
+                    self.execute_query(cursor, TRAFFIC_QUERY, TRAFFIC_QUERY_PARAMS)
+            
+            # Each request is timed on its own so the rollback gate sees real
+            # per-request latencies and outcomes, not batch averages
+            for _ in range(count):
+                success, latency_ns = self.execute_query(
+                    cursor, TRAFFIC_QUERY, TRAFFIC_QUERY_PARAMS
+                )
+                
+                rows.append(
+                    (env, latency_ns, 0.0, 1, 0) if success else (env, latency_ns, 100.0, 0, 1)
+                )
             
-            env = 'canary' if use_canary else 'stable'
-            self.metrics[env].append({
-                'success': success,
-                'latency': latency
-            })
+            self.flush_metrics(cursor, rows)
+    
+    def flush_metrics(self, cursor, rows: list):
+        """Persist metric rows with one COPY"""
         
-        logger.info(f"✓ Traffic simulation complete")
+        if not rows:
+            return
+        
+        with cursor.copy("""
+            COPY deployment_metrics 
+            (environment, latency_ns, error_rate, success_count, error_count)
+            FROM STDIN
+        """) as copy:
+            for row in rows:
+                copy.write_row(row)
     
     def analyze_metrics(self) -> dict:
         """Analyze metrics from both environments"""
         
         analysis = {}
         
-        for env in ['stable', 'canary']:
-            if not self.metrics[env]:
+        for pool, env in [(self.stable_pool, 'stable'), (self.canary_pool, 'canary')]:
+            if env not in self.phase_start:
                 continue
             
-            successes = sum(1 for m in self.metrics[env] if m['success'])
-            total = len(self.metrics[env])
-            error_rate = ((total - successes) / total * 100) if total > 0 else 0
+            # Aggregate the current phase server-side instead of in Python
+            with pool.connection() as conn:
+                total, successes, avg_latency_ns, p95_latency_ns = conn.execute("""
+                    SELECT count(*),
+                           sum(success_count),
+                           avg(latency_ns),
+                           percentile_disc(0.95) WITHIN GROUP (ORDER BY latency_ns)
+                    FROM deployment_metrics
+                    WHERE environment = %s AND timestamp >= %s
+                """, (env, self.phase_start[env])).fetchone()
+            if not total:
+                continue
             
-            latencies = [m['latency'] for m in self.metrics[env]]
-            avg_latency = sum(latencies) / len(latencies) if latencies else 0
-            p95_latency = sorted(latencies)[int(len(latencies) * 0.95)] if latencies else 0
+            error_rate = (total - successes) / total * 100
             
             analysis[env] = {
                 'total_requests': total,
                 'success_count': successes,
                 'error_rate': error_rate,
-                'avg_latency': avg_latency,
-                'p95_latency': p95_latency
+                'avg_latency_ns': float(avg_latency_ns),
+                'p95_latency_ns': p95_latency_ns
             }
         
         return analysis
@@ -186,16 +340,19 @@ class CanaryDeployment:
         if 'canary' not in analysis or 'stable' not in analysis:
             return False
         
-        canary = analysis['canary']
-        stable = analysis['stable']
+        canary_err, canary_p95 = self._rollback_fields(analysis['canary'])
+        stable_err, stable_p95 = self._rollback_fields(analysis['stable'])
         
         # Rollback conditions
-        if canary['error_rate'] > stable['error_rate'] * 2:
-            logger.warning(f"⚠ Error rate spike: {canary['error_rate']:.2f}% vs {stable['error_rate']:.2f}%")
+        if canary_err > stable_err * self._err_mult:
+            logger.warning(f"⚠ Error rate spike: {canary_err:.2f}% vs {stable_err:.2f}%")
             return True
         
-        if canary['p95_latency'] > stable['p95_latency'] * 1.5:
-            logger.warning(f"⚠ Latency degradation: {canary['p95_latency']:.2f}ms vs {stable['p95_latency']:.2f}ms")
+        if canary_p95 > stable_p95 * self._lat_mult:
+            logger.warning(
+                f"⚠ Latency degradation: {canary_p95 / 1_000_000:.3f}ms "
+                f"vs {stable_p95 / 1_000_000:.3f}ms"
+            )
             return True
         
         return False
@@ -205,12 +362,20 @@ class CanaryDeployment:
         
         logger.info("Executing rollback on CANARY...")
         
-        cursor = self.canary_conn.cursor()
-        cursor.execute("DROP INDEX IF EXISTS idx_users_email_optimized")
-        cursor.close()
+        with self.canary_pool.connection() as conn:
+            conn.execute("DROP INDEX IF EXISTS idx_users_email_trgm")
         
         logger.info("✓ Rollback complete")
     
+    def teardown(self):
+        """Close the connection pools for both databases"""
+        
+        for pool in (self.stable_pool, self.canary_pool):
+            if pool is not None:
+                pool.close()
+        
+        self.stable_pool = self.canary_pool = None
+    
     def print_metrics(self, analysis: dict, phase: str):
         """Print metrics comparison"""
         
@@ -229,15 +394,18 @@ class CanaryDeployment:
             print(f"  Total Requests: {metrics['total_requests']}")
             print(f"  Success Rate: {100 - metrics['error_rate']:.2f}%")
             print(f"  Error Rate: {metrics['error_rate']:.2f}%")
-            print(f"  Avg Latency: {metrics['avg_latency']:.2f}ms")
-            print(f"  P95 Latency: {metrics['p95_latency']:.2f}ms")
+            print(f"  Avg Latency: {metrics['avg_latency_ns'] / 1_000_000:.3f}ms")
+            print(f"  P95 Latency: {metrics['p95_latency_ns'] / 1_000_000:.3f}ms")
         
         # Comparison
         if 'stable' in analysis and 'canary' in analysis:
             stable = analysis['stable']
             canary = analysis['canary']
             
-            latency_diff = ((canary['avg_latency'] - stable['avg_latency']) / stable['avg_latency'] * 100) if stable['avg_latency'] > 0 else 0
+            latency_diff = (
+                (canary['avg_latency_ns'] - stable['avg_latency_ns'])
+                / stable['avg_latency_ns'] * 100
+            ) if stable['avg_latency_ns'] > 0 else 0
             error_diff = canary['error_rate'] - stable['error_rate']
             
             print(f"\nComparison:")
@@ -263,62 +431,43 @@ class CanaryDeployment:
         print("-" * 80)
         self.apply_canary_change()
         
-        # Stage 1: 10% traffic
-        print("\nPHASE 2: 10% Canary Traffic")
-        print("-" * 80)
-        self.route_traffic(10)
-        self.simulate_traffic(200)
-        
-        analysis = self.analyze_metrics()
-        self.print_metrics(analysis, "10% Traffic")
-        
-        if self.should_rollback(analysis):
-            print("\n✗ DEPLOYMENT FAILED - Initiating Rollback")
-            self.rollback_canary()
-            return
-        
-        print("\n✓ 10% phase successful")
-        time.sleep(2)
-        
-        # Stage 2: 50% traffic
-        print("\nPHASE 3: 50% Canary Traffic")
-        print("-" * 80)
-        self.metrics = {'stable': [], 'canary': []}  # Reset
-        self.route_traffic(50)
-        self.simulate_traffic(200)
-        
-        analysis = self.analyze_metrics()
-        self.print_metrics(analysis, "50% Traffic")
-        
-        if self.should_rollback(analysis):
-            print("\n✗ DEPLOYMENT FAILED - Initiating Rollback")
-            self.rollback_canary()
-            return
-        
-        print("\n✓ 50% phase successful")
-        time.sleep(2)
-        
-        # Stage 3: 100% traffic
-        print("\nPHASE 4: 100% Canary Traffic (Full Rollout)")
-        print("-" * 80)
-        self.metrics = {'stable': [], 'canary': []}
-        self.route_traffic(100)
-        self.simulate_traffic(200)
-        
-        analysis = self.analyze_metrics()
-        self.print_metrics(analysis, "100% Traffic")
+        # Progressive stages: canary percentage and phase heading
+        stages = [
+            (10, "PHASE 2: 10% Canary Traffic"),
+            (50, "PHASE 3: 50% Canary Traffic"),
+            (100, "PHASE 4: 100% Canary Traffic (Full Rollout)"),
+        ]
+        
+        for percentage, heading in stages:
+            print(f"\n{heading}")
+            print("-" * 80)
+            self.route_traffic(percentage)
+            self.simulate_traffic(200)
+            
+            analysis = self.analyze_metrics()
+            self.print_metrics(analysis, f"{percentage}% Traffic")
+            
+            # Full rollout is promoted without a further gate
+            if percentage == 100:
+                break
+            
+            if self.should_rollback(analysis):
+                print("\n✗ DEPLOYMENT FAILED - Initiating Rollback")
+                self.rollback_canary()
+                return
+            
+            print(f"\n✓ {percentage}% phase successful")
         
         # Promote canary to stable
         print("\nPHASE 5: Promote Canary to Stable")
         print("-" * 80)
         logger.info("Applying change to stable environment...")
         
-        cursor = self.stable_conn.cursor()
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_users_email_optimized 
-            ON users(email, username);
-        """)
-        cursor.close()
+        with self.stable_pool.connection() as conn:
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_users_email_trgm 
+                ON users USING gin(email gin_trgm_ops);
+            """)
         
         logger.info("✓ Change promoted to stable")
         
@@ -335,7 +484,10 @@ class CanaryDeployment:
 
 def main():
     canary = CanaryDeployment()
-    canary.run_canary_deployment()
+    try:
+        canary.run_canary_deployment()
+    finally:
+        canary.teardown()
 
 
 if __name__ == "__main__":
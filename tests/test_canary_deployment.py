@@ -0,0 +1,289 @@
+import pytest
+from datetime import datetime
+from decimal import Decimal
+from unittest.mock import MagicMock, patch
+import sys
+sys.path.append('src')
+
+from canary_deployment import CanaryDeployment
+
+
+def mock_pool(cursor):
+    """Pool whose connection() and cursor() context managers yield the given cursor"""
+    conn = MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cursor
+    pool = MagicMock()
+    pool.connection.return_value.__enter__.return_value = conn
+    return pool
+
+
+@pytest.fixture
+def canary():
+    """Deployment wired to mock pools instead of live databases"""
+    deployment = CanaryDeployment()
+    deployment.stable_pool = mock_pool(MagicMock())
+    deployment.canary_pool = mock_pool(MagicMock())
+    return deployment
+
+
+def session_cursor(pool):
+    """The cursor a pool's checked-out connection hands out"""
+    conn = pool.connection.return_value.__enter__.return_value
+    return conn.cursor.return_value.__enter__.return_value
+
+
+class TestSimulateTraffic:
+    """Test per-request traffic and metric rows"""
+
+    def simulate(self, canary, percentage, results):
+        """Run one phase with mocked query results, returning the flushed rows per cursor"""
+        canary.route_traffic(percentage)
+
+        with patch('canary_deployment.WARM_UP_REQUESTS', 0), \
+                patch.object(canary, 'execute_query', side_effect=results) as execute, \
+                patch.object(canary, 'flush_metrics') as flush:
+            canary.simulate_traffic(len(results))
+
+        rows = {call.args[0]: call.args[1] for call in flush.call_args_list}
+        return execute, rows
+
+    def test_rows_per_request(self, canary):
+        """Each request gets its own latency and outcome columns"""
+        execute, rows = self.simulate(canary, 100, [(True, 1500), (False, 2500)])
+
+        assert rows[session_cursor(canary.canary_pool)] == [
+            ('canary', 1500, 0.0, 1, 0),
+            ('canary', 2500, 100.0, 0, 1),
+        ]
+        assert rows[session_cursor(canary.stable_pool)] == []
+
+    def test_shares_run_back_to_back(self, canary):
+        """Each environment's requests run contiguously on its own session"""
+        execute, rows = self.simulate(canary, 50, [(True, 1000)] * 40)
+
+        stable_cursor = session_cursor(canary.stable_pool)
+        canary_cursor = session_cursor(canary.canary_pool)
+        stable_count = len(rows[stable_cursor])
+        assert stable_count + len(rows[canary_cursor]) == 40
+        assert [call.args[0] for call in execute.call_args_list] == (
+            [stable_cursor] * stable_count + [canary_cursor] * (40 - stable_count)
+        )
+
+    def test_one_session_per_environment(self, canary):
+        """A phase checks out a single connection from each pool and marks its start"""
+        self.simulate(canary, 50, [(True, 1000)] * 40)
+
+        assert canary.stable_pool.connection.call_count == 1
+        assert canary.canary_pool.connection.call_count == 1
+        assert set(canary.phase_start) == {'stable', 'canary'}
+
+    def test_warm_up_not_recorded(self, canary):
+        """A session with traffic runs untimed warm-up queries that get no metric row"""
+        canary.route_traffic(100)
+
+        with patch('canary_deployment.WARM_UP_REQUESTS', 3), \
+                patch.object(canary, 'execute_query', return_value=(True, 1500)) as execute, \
+                patch.object(canary, 'flush_metrics') as flush:
+            canary.simulate_traffic(2)
+
+        canary_cursor = session_cursor(canary.canary_pool)
+        assert [call.args[0] for call in execute.call_args_list] == [canary_cursor] * 5
+        rows = {call.args[0]: call.args[1] for call in flush.call_args_list}
+        assert rows[canary_cursor] == [('canary', 1500, 0.0, 1, 0)] * 2
+        assert rows[session_cursor(canary.stable_pool)] == []
+
+    def test_execute_query_failure(self, canary):
+        """A failing statement is reported as unsuccessful with its latency"""
+        cursor = MagicMock()
+        cursor.execute.side_effect = Exception("boom")
+
+        success, latency_ns = canary.execute_query(cursor, "SELECT 1")
+
+        assert success is False
+        assert isinstance(latency_ns, int) and latency_ns >= 0
+
+
+def phase_result(pool, row):
+    """Make the pool's aggregate query return row"""
+    conn = pool.connection.return_value.__enter__.return_value
+    conn.execute.return_value.fetchone.return_value = row
+
+
+class TestAnalyzeMetrics:
+    """Test mapping the server-side phase aggregates"""
+
+    def test_aggregates_mapped(self, canary):
+        """count, sum, avg and percentile_disc become the analysis fields"""
+        canary.phase_start = {'stable': datetime(2024, 1, 1), 'canary': datetime(2024, 1, 1)}
+        phase_result(canary.stable_pool, (180, 171, Decimal('1500000.5'), 2_000_000))
+        phase_result(canary.canary_pool, (20, 20, Decimal('1200000'), 1_300_000))
+
+        result = canary.analyze_metrics()
+
+        assert result['stable'] == {
+            'total_requests': 180,
+            'success_count': 171,
+            'error_rate': 5.0,
+            'avg_latency_ns': 1500000.5,
+            'p95_latency_ns': 2_000_000,
+        }
+        assert result['canary']['error_rate'] == 0.0
+        assert isinstance(result['canary']['avg_latency_ns'], float)
+
+    def test_empty_phase_skipped(self, canary):
+        """An environment without rows in the phase is left out"""
+        canary.phase_start = {'stable': datetime(2024, 1, 1), 'canary': datetime(2024, 1, 1)}
+        phase_result(canary.stable_pool, (200, 200, Decimal('1000000'), 1_100_000))
+        phase_result(canary.canary_pool, (0, None, None, None))
+
+        result = canary.analyze_metrics()
+
+        assert set(result) == {'stable'}
+
+    def test_unstarted_environment_skipped(self, canary):
+        """An environment without a phase start is never queried"""
+        canary.phase_start = {'stable': datetime(2024, 1, 1)}
+        phase_result(canary.stable_pool, (200, 200, Decimal('1000000'), 1_100_000))
+
+        result = canary.analyze_metrics()
+
+        assert set(result) == {'stable'}
+        canary.canary_pool.connection.assert_not_called()
+
+
+def catalog_conn(pkey, null_timestamps=0):
+    """Connection whose primary key and NULL-timestamp lookups return the given results"""
+    conn = MagicMock()
+    pkey_result, nulls_result = MagicMock(), MagicMock()
+    pkey_result.fetchone.return_value = pkey
+    nulls_result.fetchone.return_value = (null_timestamps,)
+    conn.execute.side_effect = [pkey_result, nulls_result] + [MagicMock()] * 3
+    return conn
+
+
+def statements(conn):
+    """SQL text of every statement run on conn, composed or plain"""
+    executed = []
+    for call in conn.execute.call_args_list:
+        query = call.args[0]
+        executed.append(query if isinstance(query, str) else query.as_string(None))
+    return executed
+
+
+class TestMigrateMetricsPrimaryKey:
+    """Test moving legacy deployment_metrics keys onto (metric_id, timestamp)"""
+
+    def test_current_key_untouched(self, canary):
+        """A key that already includes timestamp needs no migration"""
+        conn = catalog_conn(('deployment_metrics_pkey', ['metric_id', 'timestamp']))
+
+        assert canary._migrate_metrics_primary_key(conn, 'stable') is True
+        assert conn.execute.call_count == 1
+
+    def test_legacy_key_replaced(self, canary):
+        """PRIMARY KEY (metric_id) is dropped by its own name and recreated with timestamp"""
+        conn = catalog_conn(('dm_pk', ['metric_id']))
+
+        assert canary._migrate_metrics_primary_key(conn, 'stable') is True
+        executed = statements(conn)
+        assert any('DROP CONSTRAINT "dm_pk"' in stmt for stmt in executed)
+        assert 'ADD PRIMARY KEY (metric_id, timestamp)' in executed[-1]
+
+    def test_missing_key_added(self, canary):
+        """A table without a primary key gets one without dropping anything"""
+        conn = catalog_conn(None)
+
+        assert canary._migrate_metrics_primary_key(conn, 'stable') is True
+        executed = statements(conn)
+        assert not any('DROP CONSTRAINT' in stmt for stmt in executed)
+        assert 'ADD PRIMARY KEY (metric_id, timestamp)' in executed[-1]
+
+    def test_null_timestamps_stop_migration(self, canary):
+        """Rows without a timestamp are reported instead of failing SET NOT NULL"""
+        conn = catalog_conn(('deployment_metrics_pkey', ['metric_id']), null_timestamps=3)
+
+        assert canary._migrate_metrics_primary_key(conn, 'stable') is False
+        assert conn.execute.call_count == 2
+
+
+def analysis(stable_err=1.0, stable_p95=100_000, canary_err=1.0, canary_p95=100_000):
+    """Build an analyze_metrics-shaped result"""
+    return {
+        'stable': {'error_rate': stable_err, 'p95_latency_ns': stable_p95},
+        'canary': {'error_rate': canary_err, 'p95_latency_ns': canary_p95},
+    }
+
+
+class TestShouldRollback:
+    """Test the rollback gate"""
+
+    def test_healthy_canary(self, canary):
+        """Comparable metrics do not trigger a rollback"""
+        assert canary.should_rollback(analysis(canary_p95=140_000)) is False
+
+    def test_error_rate_spike(self, canary):
+        """Canary error rate above twice stable triggers a rollback"""
+        assert canary.should_rollback(analysis(canary_err=2.5)) is True
+
+    def test_latency_degradation(self, canary):
+        """Canary p95 above 1.5x stable triggers a rollback"""
+        assert canary.should_rollback(analysis(canary_p95=150_001)) is True
+
+    def test_thresholds_are_exclusive(self, canary):
+        """Metrics exactly at the multipliers are still accepted"""
+        assert canary.should_rollback(analysis(canary_err=2.0, canary_p95=150_000)) is False
+
+    def test_missing_environment(self, canary):
+        """Without both environments there is nothing to compare"""
+        assert canary.should_rollback({'stable': analysis()['stable']}) is False
+
+
+@pytest.fixture
+def rollout(canary):
+    """Deployment with every stage step mocked, so only the stage loop runs"""
+    steps = ['connect_all', 'setup', 'apply_canary_change', 'simulate_traffic',
+             'analyze_metrics', 'print_metrics', 'should_rollback', 'rollback_canary']
+    patches = [patch.object(canary, step) for step in steps]
+    mocks = {step: p.start() for step, p in zip(steps, patches)}
+    mocks['connect_all'].return_value = True
+    mocks['should_rollback'].return_value = False
+    yield canary, mocks
+    for p in patches:
+        p.stop()
+
+
+class TestRunCanaryDeployment:
+    """Test the progressive rollout stages"""
+
+    def test_rollback_returns_before_promotion(self, rollout):
+        """A rollback at 10% stops the rollout without touching stable"""
+        canary, mocks = rollout
+        mocks['should_rollback'].return_value = True
+
+        canary.run_canary_deployment()
+
+        mocks['rollback_canary'].assert_called_once()
+        assert mocks['simulate_traffic'].call_count == 1
+        assert canary.canary_percentage == 10
+        canary.stable_pool.connection.assert_not_called()
+
+    def test_full_rollout_skips_rollback_gate(self, rollout):
+        """The 100% stage is promoted without calling should_rollback"""
+        canary, mocks = rollout
+
+        canary.run_canary_deployment()
+
+        assert mocks['should_rollback'].call_count == 2
+        mocks['rollback_canary'].assert_not_called()
+        assert canary.canary_percentage == 100
+        canary.stable_pool.connection.assert_called_once()
+
+    def test_stage_labels(self, rollout):
+        """Each stage prints its metrics under the '{pct}% Traffic' label"""
+        canary, mocks = rollout
+
+        canary.run_canary_deployment()
+
+        labels = [call.args[1] for call in mocks['print_metrics'].call_args_list]
+        assert labels == ['10% Traffic', '50% Traffic', '100% Traffic']
+        assert [call.args[0] for call in mocks['simulate_traffic'].call_args_list] == [200] * 3